@@ -1,135 +1,678 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, session, Response, stream_with_context
 from flask_cors import CORS
+from flask_compress import Compress
+import orjson
 import chess
 import chess.engine
 import chess.pgn
+import chess.polyglot
 import os
+import re
+import shutil
 import logging
+import functools
+import time
+import array
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
 app = Flask(__name__)
-CORS(app)
+app.secret_key = os.environ.get('SECRET_KEY') or os.urandom(24)
+# Credentialed, so cross-origin frontends keep their session cookie
+CORS(app, supports_credentials=True)
+
+# Brotli for clients that accept it, gzip otherwise; tiny bodies go out as is
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_BR_LEVEL'] = 4
+app.config['COMPRESS_MIN_SIZE'] = 200
+Compress(app)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class ChessGame:
-    def __init__(self):
-        self.board = chess.Board()
-        self.engine_path = self.find_stockfish()
-        self.engine = None
-        self.game_history = []
-        self.difficulty = 1  # Stockfish depth level
+# Maximum number of (position, depth) -> best move entries shared by all games
+MOVE_CACHE_SIZE = 100_000
+
+# Optional Polyglot opening book (e.g. Perfect2023.bin renamed to book.bin)
+BOOK_PATH = 'book.bin'
+
+# Stockfish worker processes shared by all sessions, one search each
+ENGINE_POOL_SIZE = os.cpu_count() or 1
+
+# Games kept in memory; the least recently used one is dropped beyond this
+MAX_SESSIONS = 256
+
+# Most positions a single /api/analyze request may submit
+MAX_ANALYSE_BATCH = 32
+
+# Shape of a UCI move string as sent by the client, e.g. e2e4 or e7e8q
+UCI_MOVE_RE = re.compile(r'[a-h][1-8][a-h][1-8][qrbn]?')
+
+# Move history player codes, one byte per move
+PLAYER_CODES = {'human': ord('h'), 'ai': ord('a')}
+PLAYER_NAMES = {code: name for name, code in PLAYER_CODES.items()}
+
+# Where to look for Stockfish when it is not on PATH
+STOCKFISH_PATHS = (
+    './stockfish.exe',  # Your local stockfish.exe
+    './stockfish/stockfish.exe',  # If in stockfish subfolder
+    './stockfish',
+    '/usr/bin/stockfish',
+    '/usr/local/bin/stockfish'
+)
+
+@functools.lru_cache(maxsize=1)
+def _resolve_stockfish():
+    """Find the Stockfish executable once per process, PATH first"""
+    # shutil.which walks PATH with os.pathsep (and PATHEXT on Windows)
+    path = shutil.which('stockfish') or shutil.which('stockfish.exe')
+    if path:
+        logger.info(f"Found Stockfish on PATH: {path}")
+        return path
+    
+    for path in STOCKFISH_PATHS:
+        # isfile, not exists: ./stockfish is usually the folder holding the binary
+        if os.path.isfile(path):
+            logger.info(f"Found Stockfish at: {path}")
+            return path
+    
+    logger.error("Stockfish executable not found in any common locations")
+    return None
+
+def open_book():
+    """Open the Polyglot opening book if one is present"""
+    if not os.path.exists(BOOK_PATH):
+        logger.info(f"No opening book at {BOOK_PATH}, using the engine from move one")
+        return None
+    try:
+        # The reader memory-maps the file, so probes never hit the disk twice
+        book = chess.polyglot.open_reader(BOOK_PATH)
+        logger.info(f"Opening book loaded from {BOOK_PATH}")
+        return book
+    except Exception as e:
+        logger.error(f"Failed to open book: {e}")
+        return None
+
+def binary_fen(board):
+    """Pack a position into 32 bytes, one nibble per square
+    
+    Move counters are left out so transpositions collide. As in lichess's
+    BinaryFen, spare nibble codes carry the rest of the state: a pawn that
+    can be taken en passant, a rook that can still castle, and the black
+    king when black is to move.
+    """
+    nibbles = [0] * 64
+    for square, piece in board.piece_map().items():
+        nibbles[square] = piece.piece_type + (6 if piece.color == chess.BLACK else 0)
+    if board.has_legal_en_passant():
+        nibbles[board.ep_square + (-8 if board.turn == chess.WHITE else 8)] = 13
+    for square in chess.scan_forward(board.clean_castling_rights()):
+        nibbles[square] = 14
+    if board.turn == chess.BLACK:
+        nibbles[board.king(chess.BLACK)] = 15
+    return bytes(nibbles[i] | nibbles[i + 1] << 4 for i in range(0, 64, 2))
+
+def ojsonify(obj):
+    """jsonify() replacement that encodes with orjson"""
+    return Response(orjson.dumps(obj), mimetype='application/json')
+
+def ndjson_line(obj):
+    """Encode one line of a newline-delimited JSON stream"""
+    return orjson.dumps(obj) + b'\n'
+
+def drain(generator):
+    """Run a generator to the end, discarding what it yields, and return its result"""
+    while True:
+        try:
+            next(generator)
+        except StopIteration as done:
+            return done.value
+
+class EnginePool:
+    """Fixed set of Stockfish processes lent to games one search at a time"""
+    def __init__(self, size):
+        self.size = size
+        self.engine_path = _resolve_stockfish()
+        self._engines = []
+        self._idle = []
+        self._idle_cond = threading.Condition()
+        self._lock = threading.Lock()
+        # Ponder searches currently holding an engine, preempted when a move needs one
+        self._ponders = set()
+        self._ponders_lock = threading.Lock()
+        # Best move per (position, depth), least recently used first
+        self._move_cache = OrderedDict()
+        self._move_cache_lock = threading.Lock()
+    
+    def start(self):
+        """Spawn the worker engines; does nothing if they are already running"""
+        with self._lock:
+            if self._engines:
+                return True
+            if not self.engine_path:
+                logger.error("Stockfish not found")
+                return False
+            try:
+                for _ in range(self.size):
+                    engine = self._spawn()
+                    self._engines.append(engine)
+                    self._put(engine)
+                logger.info(f"Started {self.size} Stockfish engines at {self.engine_path}")
+                return True
+            except Exception as e:
+                logger.error(f"Failed to start engine: {e}")
+                self._quit_all()
+                return False
+    
+    def _spawn(self):
+        """Start and warm up one worker engine"""
+        engine = chess.engine.SimpleEngine.popen_uci(self.engine_path)
+        try:
+            # One thread and a modest hash per worker, so the pool
+            # spreads across cores instead of oversubscribing them
+            engine.configure({'Threads': 1, 'Hash': 128})
+            # A throwaway search pages the NNUE network in before the first game
+            engine.play(chess.Board(), chess.engine.Limit(depth=1))
+        except Exception:
+            engine.close()
+            raise
+        return engine
+    
+    def _checked(self, engine):
+        """Return the engine, a replacement if its process exited, or None if it must be dropped"""
+        if not engine.protocol.returncode.done():
+            return engine
         
-    def find_stockfish(self):
-        """Find Stockfish executable in common locations"""
-        possible_paths = [
-            './stockfish.exe',  # Your local stockfish.exe
-            './stockfish/stockfish.exe',  # If in stockfish subfolder
-            'stockfish.exe',  # Current directory
-            'stockfish',  # If in PATH
-            './stockfish',
-            '/usr/bin/stockfish',
-            '/usr/local/bin/stockfish',
-            'C:\\Program Files\\stockfish\\stockfish.exe',
-            'C:\\stockfish\\stockfish.exe'
-        ]
+        try:
+            engine.close()
+        except Exception as e:
+            logger.debug(f"Engine close failed: {e}")
         
-        for path in possible_paths:
+        with self._lock:
+            if engine not in self._engines:
+                return None
+            self._engines.remove(engine)
+            logger.warning("Stockfish engine died, starting a replacement")
             try:
-                if os.path.exists(path) or path == 'stockfish':
-                    logger.info(f"Found Stockfish at: {path}")
-                    return path
+                replacement = self._spawn()
             except Exception as e:
-                logger.debug(f"Path {path} not accessible: {e}")
-                continue
+                logger.error(f"Failed to start engine: {e}")
+                return None
+            self._engines.append(replacement)
+            return replacement
+    
+    def stop(self):
+        """Stop all worker engines"""
+        with self._lock:
+            self._quit_all()
+    
+    def _quit_all(self):
+        for engine in self._engines:
+            try:
+                engine.quit()
+            except Exception as e:
+                logger.debug(f"Engine quit failed: {e}")
+        self._engines = []
+        with self._idle_cond:
+            self._idle = []
+    
+    def _put(self, engine):
+        with self._idle_cond:
+            self._idle.append(engine)
+            self._idle_cond.notify()
+    
+    def _take(self, preferred=None, block=True):
+        """Pop an idle engine, preferring `preferred`; None if none and not blocking"""
+        with self._idle_cond:
+            while not self._idle:
+                if not block:
+                    return None
+                self._idle_cond.wait()
+            if preferred is not None and preferred in self._idle:
+                self._idle.remove(preferred)
+                return preferred
+            return self._idle.pop()
+    
+    @contextmanager
+    def engine(self, preferred=None):
+        """Borrow an engine for the duration of a with-block, waiting if all are busy
         
-        logger.error("Stockfish executable not found in any common locations")
-        return None
+        `preferred` is handed out if idle, so a game returns to the engine
+        whose hash table already holds its positions.
+        """
+        engine = self._acquire(preferred)
+        try:
+            yield engine
+        finally:
+            self.release(engine)
     
-    def start_engine(self):
-        """Initialize the chess engine"""
+    def _acquire(self, preferred=None):
+        while True:
+            engine = self.try_acquire(preferred)
+            if engine is not None:
+                return engine
+            
+            # A real move outranks guesswork for someone else's game
+            self._preempt_ponder()
+            engine = self._checked(self._take(preferred))
+            if engine is not None:
+                return engine
+    
+    def add_ponder(self, ponder):
+        """Register a ponder search so a waiting move can preempt it"""
+        with self._ponders_lock:
+            self._ponders.add(ponder)
+    
+    def discard_ponder(self, ponder):
+        """Forget a ponder search that has finished"""
+        with self._ponders_lock:
+            self._ponders.discard(ponder)
+    
+    def _preempt_ponder(self):
+        """Stop one running ponder search so its engine returns to the pool"""
+        with self._ponders_lock:
+            ponder = self._ponders.pop() if self._ponders else None
+        if ponder is not None:
+            ponder.interrupt()
+    
+    def try_acquire(self, preferred=None):
+        """Borrow an engine without waiting; returns None if all are busy"""
+        while True:
+            engine = self._take(preferred, block=False)
+            if engine is None:
+                return None
+            engine = self._checked(engine)
+            if engine is not None:
+                return engine
+    
+    def release(self, engine):
+        """Return an engine obtained from try_acquire, replacing it if it died"""
+        engine = self._checked(engine)
+        if engine is not None:
+            self._put(engine)
+    
+    def cached_move(self, key):
+        """Return the cached best move for a (position, depth) key, or None"""
+        with self._move_cache_lock:
+            uci = self._move_cache.get(key)
+            if uci is not None:
+                self._move_cache.move_to_end(key)
+            return uci
+    
+    def cache_move(self, key, uci):
+        """Remember the best move for a (position, depth) key"""
+        with self._move_cache_lock:
+            self._move_cache[key] = uci
+            self._move_cache.move_to_end(key)
+            if len(self._move_cache) > MOVE_CACHE_SIZE:
+                self._move_cache.popitem(last=False)
+    
+    def analyse_batch(self, fens, depth):
+        """Best move in UCI notation (None if there is none) for each FEN, searched in parallel
+        
+        Raises ValueError for an unparsable FEN or illegal position, which would crash Stockfish.
+        """
+        boards = []
+        for fen in fens:
+            board = chess.Board(fen)
+            if not board.is_valid():
+                raise ValueError(f"illegal position: {fen!r}")
+            boards.append(board)
+        
+        def analyse(board):
+            with self.engine() as engine:
+                info = engine.analyse(board, chess.engine.Limit(depth=depth))
+            pv = info.get('pv')
+            return pv[0].uci() if pv else None
+        
+        # At most half the pool, leaving engines for live games
+        with ThreadPoolExecutor(max_workers=max(1, self.size // 2)) as executor:
+            return list(executor.map(analyse, boards))
+
+class PonderSearch:
+    """Background analysis that hands its engine back to the pool when done"""
+    def __init__(self, pool, engine, board, depth, game):
+        self.ply = len(board.move_stack)
+        self._pool = pool
+        self._engine = engine
+        self._lock = threading.Lock()
+        self._finished = False
+        self._analysis = engine.analysis(board, chess.engine.Limit(depth=depth), game=game)
+        pool.add_ponder(self)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def _run(self):
         try:
-            if self.engine_path:
-                self.engine = chess.engine.SimpleEngine.popen_uci(self.engine_path)
-                logger.info(f"Stockfish engine started at {self.engine_path}")
-                return True
-            else:
-                logger.error("Stockfish not found")
-                return False
+            self._analysis.wait()
         except Exception as e:
-            logger.error(f"Failed to start engine: {e}")
-            return False
+            logger.warning(f"Pondering failed: {e}")
+        finally:
+            self._pool.discard_ponder(self)
+            with self._lock:
+                self._finished = True
+                self._pool.release(self._engine)
     
-    def stop_engine(self):
-        """Stop the chess engine"""
-        if self.engine:
-            self.engine.quit()
-            self.engine = None
+    def interrupt(self):
+        """Stop the search early without waiting for it to wind down"""
+        with self._lock:
+            # Once finished, the engine may already serve another game
+            if not self._finished:
+                self._analysis.stop()
     
+    def stop(self):
+        """Stop the search if it is still running and return its last info"""
+        self.interrupt()
+        self._thread.join()
+        return self._analysis.info
+
+class ChessGame:
+    def __init__(self, pool, book=None):
+        self.board = chess.Board()
+        self._position_key = None  # binary_fen() of the current position, computed on demand
+        self._state_cache = None  # get_board_state() result for the current position
+        self._legal_moves_cache = None
+        # Guards the board and the caches above against concurrent requests
+        self._lock = threading.RLock()
+        self.pool = pool
+        self.book = book
+        self._clear_history()
+        self.difficulty = 1  # Stockfish depth level
+        # Identifies the current game to the engine; a new token triggers ucinewgame
+        self._game_token = object()
+        # Pool engine this game last searched or pondered on
+        self._engine = None
+        # Background analysis of the position the human is thinking about
+        self._ponder = None
+        # Reply found by pondering on the human's actual move, used by the next think()
+        self._ponder_reply = None
+        
     def make_move(self, move_str):
         """Make a player move"""
-        try:
-            move = chess.Move.from_uci(move_str)
-            if move in self.board.legal_moves:
-                self.board.push(move)
-                self.game_history.append({
-                    'move': move_str,
-                    'player': 'human',
-                    'timestamp': datetime.now().isoformat()
-                })
-                return True
+        # Reject malformed input up front; anything that passes parses cleanly
+        if not isinstance(move_str, str) or not UCI_MOVE_RE.fullmatch(move_str):
             return False
-        except:
+        if move_str[:2] == move_str[2:4]:
             return False
+        
+        move = chess.Move.from_uci(move_str)
+        if not self.board.is_legal(move):
+            return False
+        
+        # Stop pondering before the board it searches moves on
+        self._ponder_reply = self._take_ponder_reply(move)
+        self._push(move, 'human')
+        return True
     
-    def get_engine_move(self):
-        """Get AI move from Stockfish"""
+    def think(self):
+        """Play the AI move, yielding {depth, pv, score, mate} search updates
+        
+        Returns the move played in UCI notation, or None on failure.
+        """
         try:
-            if not self.engine:
-                if not self.start_engine():
-                    return None
+            if not self.pool.start():
+                return None
             
-            result = self.engine.play(self.board, chess.engine.Limit(depth=self.difficulty))
-            move = result.move
-            self.board.push(move)
-            
-            self.game_history.append({
-                'move': move.uci(),
-                'player': 'ai',
-                'timestamp': datetime.now().isoformat()
-            })
+            reply, self._ponder_reply = self._ponder_reply, None
+            move = self._forced_move() or self._book_move() or reply
+            if move is None:
+                move = chess.Move.from_uci((yield from self._search()))
+            self._push(move, 'ai')
             
             return move.uci()
         except Exception as e:
             logger.error(f"Engine move failed: {e}")
             return None
     
-    def get_board_state(self):
-        """Get current board state"""
+    def _forced_move(self):
+        """Return the only legal move, or None if there is a choice"""
+        # Stop generating after the second move instead of listing them all
+        moves = self.board.generate_legal_moves()
+        first = next(moves, None)
+        if first is not None and next(moves, None) is None:
+            return first
+        return None
+    
+    def _book_move(self):
+        """Return a weighted random book move, or None when out of book"""
+        if self.book is None:
+            return None
+        try:
+            return self.book.weighted_choice(self.board).move
+        except IndexError:
+            return None
+    
+    def _clear_history(self):
+        """Start an empty move history"""
+        # Parallel arrays, one slot per move: UCI string, player code and
+        # wall-clock nanoseconds (formatted only on output)
+        self.moves_uci = []
+        self.players = bytearray()
+        self.timestamps = array.array('q')
+    
+    def _record(self, move_uci, player):
+        """Append a move to the history"""
+        self.moves_uci.append(move_uci)
+        self.players.append(PLAYER_CODES[player])
+        self.timestamps.append(time.time_ns())
+    
+    def history(self):
+        """Move history as a list of dicts; orjson writes the datetimes as ISO 8601"""
+        return [
+            {
+                'move': move,
+                'player': PLAYER_NAMES[player],
+                'timestamp': datetime.fromtimestamp(ts_ns / 1e9)
+            }
+            for move, player, ts_ns in zip(self.moves_uci, self.players, self.timestamps)
+        ]
+    
+    def _push(self, move, player):
+        """Play and record a move, invalidating per-position caches"""
+        with self._lock:
+            self.board.push(move)
+            self._record(move.uci(), player)
+            self._position_key = None
+            self._state_cache = None
+            self._legal_moves_cache = None
+    
+    def position_key(self):
+        """Packed key of the current position; transpositions share a key"""
+        with self._lock:
+            if self._position_key is None:
+                self._position_key = binary_fen(self.board)
+            return self._position_key
+    
+    def state_tag(self):
+        """Validator for the current position, taken atomically with respect to moves"""
+        with self._lock:
+            return f"{self.position_key().hex()}-{self.board.ply()}-{self.board.halfmove_clock}"
+    
+    def _search(self):
+        """Yield search progress and return the best move in UCI notation"""
+        # Positions are shared across games, so repeated openings skip the search
+        key = (self.position_key(), self.difficulty)
+        uci = self.pool.cached_move(key)
+        if uci is not None:
+            return uci
+        
+        # The engine this game last used still holds its positions in the hash
+        # table; the stable game token keeps python-chess from sending ucinewgame
+        with self.pool.engine(preferred=self._engine) as engine:
+            self._engine = engine
+            with engine.analysis(
+                self.board.copy(),
+                chess.engine.Limit(depth=self.difficulty),
+                game=self._game_token
+            ) as analysis:
+                for info in analysis:
+                    if 'pv' in info and 'score' in info:
+                        score = info['score'].white()
+                        yield {
+                            'depth': info.get('depth'),
+                            'pv': info['pv'][0].uci(),
+                            'score': score.score(),
+                            'mate': score.mate()
+                        }
+                best = analysis.wait()
+        uci = best.move.uci()
+        self.pool.cache_move(key, uci)
+        return uci
+    
+    def start_pondering(self):
+        """Analyse the current position while the human thinks (permanent brain)"""
+        if self._ponder or self.board.is_game_over():
+            return
+        
+        # Only ponder on a spare engine; other sessions' moves come first
+        engine = self.pool.try_acquire(preferred=self._engine)
+        if engine is None:
+            return
+        self._engine = engine
+        
+        # One ply deeper than the playing depth, so the reply in pv[1] has
+        # been searched to the configured difficulty
+        try:
+            self._ponder = PonderSearch(
+                self.pool,
+                engine,
+                self.board.copy(),
+                self.difficulty + 1,
+                self._game_token
+            )
+        except Exception as e:
+            self.pool.release(engine)
+            logger.warning(f"Pondering failed to start: {e}")
+    
+    def stop_pondering(self):
+        """Stop background analysis and return its last info, if any"""
+        ponder, self._ponder = self._ponder, None
+        if ponder is None:
+            return None
+        try:
+            return ponder.stop()
+        except Exception as e:
+            logger.warning(f"Pondering failed: {e}")
+            return None
+    
+    def _take_ponder_reply(self, move):
+        """Stop pondering; return the pondered reply if `move` was the predicted one"""
+        ponder_ply = self._ponder.ply if self._ponder else None
+        info = self.stop_pondering()
+        if not info or len(self.board.move_stack) != ponder_ply:
+            return None
+        
+        pv = info.get('pv', [])
+        if len(pv) >= 2 and pv[0] == move and info.get('depth', 0) > self.difficulty:
+            return pv[1]
+        return None
+    
+    def get_board_state(self, include_moves=False):
+        """Get current board state, reused until the next move
+        
+        legal_moves needs a full move generation pass, so it is only
+        included when the caller asks for it.
+        """
+        with self._lock:
+            if self._state_cache is None:
+                self._state_cache = self._build_board_state()
+            if not include_moves:
+                return self._state_cache
+            
+            if self._legal_moves_cache is None:
+                self._legal_moves_cache = self._legal_moves_uci()
+            return {**self._state_cache, 'legal_moves': self._legal_moves_cache}
+    
+    def _legal_moves_uci(self):
+        """Legal moves in UCI notation, formatted inline instead of via Move.uci()"""
+        names = chess.SQUARE_NAMES
+        symbols = chess.PIECE_SYMBOLS
+        return [
+            names[move.from_square] + names[move.to_square] + (symbols[move.promotion] if move.promotion else '')
+            for move in self.board.generate_legal_moves()
+        ]
+    
+    def _build_board_state(self):
+        board = self.board
+        # One move generation pass answers checkmate, stalemate and most of game over
+        has_moves = any(board.generate_legal_moves())
+        in_check = board.is_check()
         return {
-            'fen': self.board.fen(),
-            'turn': 'white' if self.board.turn else 'black',
-            'is_check': self.board.is_check(),
-            'is_checkmate': self.board.is_checkmate(),
-            'is_stalemate': self.board.is_stalemate(),
-            'is_game_over': self.board.is_game_over(),
-            'legal_moves': [move.uci() for move in self.board.legal_moves],
-            'move_count': len(self.game_history)
+            'fen': board.fen(),
+            'turn': 'white' if board.turn else 'black',
+            'is_check': in_check,
+            'is_checkmate': in_check and not has_moves,
+            'is_stalemate': not in_check and not has_moves,
+            'is_game_over': (
+                not has_moves
+                or board.is_insufficient_material()
+                or board.is_seventyfive_moves()
+                or board.is_fivefold_repetition()
+            ),
+            'move_count': len(self.moves_uci)
         }
     
     def reset_game(self):
         """Reset the game"""
-        self.board = chess.Board()
-        self.game_history = []
+        self.stop_pondering()
+        self._ponder_reply = None
+        with self._lock:
+            self.board = chess.Board()
+            self._position_key = None
+            self._state_cache = None
+            self._legal_moves_cache = None
+            self._clear_history()
+        self._game_token = object()
     
     def set_difficulty(self, level):
         """Set AI difficulty (1-20, higher is stronger)"""
         self.difficulty = max(1, min(20, level))
 
-# Global game instance
-game = ChessGame()
+engine_pool = EnginePool(ENGINE_POOL_SIZE)
+opening_book = open_book()
+
+# Per-session games, most recently used last
+games = OrderedDict()
+games_lock = threading.Lock()
+
+def request_game_id():
+    """Game id from the X-Game-Id header, falling back to the session cookie"""
+    return request.headers.get('X-Game-Id') or session.get('game_id')
+
+def get_game():
+    """Return the client's game, or None if it has not called /api/start"""
+    game_id = request_game_id()
+    if not game_id:
+        return None
+    with games_lock:
+        game = games.get(game_id)
+        if game is not None:
+            games.move_to_end(game_id)
+    return game
+
+def create_game():
+    """Create a game for the client and return its id and the game"""
+    game_id = uuid.uuid4().hex
+    game = ChessGame(engine_pool, opening_book)
+    evicted = None
+    with games_lock:
+        games[game_id] = game
+        if len(games) > MAX_SESSIONS:
+            _, evicted = games.popitem(last=False)
+    session['game_id'] = game_id
+    
+    if evicted:
+        evicted.stop_pondering()
+    return game_id, game
+
+def no_game():
+    """Error response for requests made before /api/start"""
+    return ojsonify({'success': False, 'error': 'No game in progress, call /api/start first'}), 404
 
 @app.route('/')
 def index():
@@ -143,83 +686,148 @@ def start_game():
         data = request.get_json() or {}
         difficulty = data.get('difficulty', 1)
         
+        game_id = request_game_id()
+        game = get_game()
+        if game is None:
+            game_id, game = create_game()
         game.reset_game()
         game.set_difficulty(difficulty)
         
-        if not game.start_engine():
-            return jsonify({
+        if not engine_pool.start():
+            return ojsonify({
                 'success': False,
                 'error': 'Could not start chess engine. Please ensure Stockfish is installed.'
             }), 500
         
-        return jsonify({
+        return ojsonify({
             'success': True,
-            'board_state': game.get_board_state()
+            'game_id': game_id,
+            'board_state': game.get_board_state(include_moves=True)
         })
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return ojsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/move', methods=['POST'])
 def make_move():
-    """Make a player move"""
+    """Make a player move
+    
+    While the AI searches, the response streams newline-delimited JSON: one
+    {depth, pv, score, mate} line per search update, then a final line with
+    the usual success/board_state/ai_move/game_over payload.
+    """
     try:
         data = request.get_json()
         move = data.get('move')
         
         if not move:
-            return jsonify({'success': False, 'error': 'Move required'}), 400
+            return ojsonify({'success': False, 'error': 'Move required'}), 400
         
         # Make player move
+        game = get_game()
+        if game is None:
+            return no_game()
         if not game.make_move(move):
-            return jsonify({'success': False, 'error': 'Invalid move'}), 400
+            return ojsonify({'success': False, 'error': 'Invalid move'}), 400
         
-        board_state = game.get_board_state()
+        board_state = game.get_board_state(include_moves=True)
         
         # Check if game is over after player move
         if board_state['is_game_over']:
-            return jsonify({
+            return ojsonify({
                 'success': True,
                 'board_state': board_state,
                 'ai_move': None,
                 'game_over': True
             })
         
-        # Get AI response move
-        ai_move = game.get_engine_move()
-        if not ai_move:
-            return jsonify({'success': False, 'error': 'AI move failed'}), 500
-        
-        return jsonify({
-            'success': True,
-            'board_state': game.get_board_state(),
-            'ai_move': ai_move,
-            'game_over': game.get_board_state()['is_game_over']
-        })
+        if not engine_pool.start():
+            return ojsonify({'success': False, 'error': 'AI move failed'}), 500
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return ojsonify({'success': False, 'error': str(e)}), 500
+    
+    def generate():
+        try:
+            # Get AI response move, flushing each search update as it arrives
+            thinking = game.think()
+            try:
+                while True:
+                    try:
+                        info = next(thinking)
+                    except StopIteration as done:
+                        ai_move = done.value
+                        break
+                    yield ndjson_line(info)
+            except GeneratorExit:
+                # The client went away mid-search; still play the move so the game can go on
+                if drain(thinking):
+                    game.start_pondering()
+                raise
+            
+            if not ai_move:
+                yield ndjson_line({'success': False, 'error': 'AI move failed'})
+                return
+            
+            # Think on the human's clock until the next move arrives
+            game.start_pondering()
+            
+            board_state = game.get_board_state(include_moves=True)
+            yield ndjson_line({
+                'success': True,
+                'board_state': board_state,
+                'ai_move': ai_move,
+                'game_over': board_state['is_game_over']
+            })
+        except Exception as e:
+            yield ndjson_line({'success': False, 'error': str(e)})
+    
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # Keep Nginx from buffering the progress lines until the search ends
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/api/board', methods=['GET'])
 def get_board():
-    """Get current board state"""
+    """Get current board state; pass ?legal_moves=1 to include legal moves
+    
+    Responses carry an ETag for the position, so polling clients get an
+    empty 304 until a move is made.
+    """
     try:
-        return jsonify({
+        game = get_game()
+        if game is None:
+            return no_game()
+        include_moves = request.args.get('legal_moves') == '1'
+        # Weak, so Flask-Compress leaves it alone instead of suffixing the encoding;
+        # the moves flag keeps the two response bodies from sharing a validator
+        etag = f"{game.state_tag()}-{int(include_moves)}"
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+        
+        response = ojsonify({
             'success': True,
-            'board_state': game.get_board_state()
+            'board_state': game.get_board_state(include_moves=include_moves)
         })
+        response.set_etag(etag, weak=True)
+        return response
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return ojsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/reset', methods=['POST'])
 def reset_game():
     """Reset the current game"""
     try:
+        game = get_game()
+        if game is None:
+            return no_game()
         game.reset_game()
-        return jsonify({
+        return ojsonify({
             'success': True,
-            'board_state': game.get_board_state()
+            'board_state': game.get_board_state(include_moves=True)
         })
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return ojsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/difficulty', methods=['POST'])
 def set_difficulty():
@@ -227,26 +835,70 @@ def set_difficulty():
     try:
         data = request.get_json()
         level = data.get('level', 1)
+        game = get_game()
+        if game is None:
+            return no_game()
         game.set_difficulty(level)
         
-        return jsonify({
+        return ojsonify({
             'success': True,
             'difficulty': game.difficulty
         })
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return ojsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/analyze', methods=['POST'])
+def analyze_positions():
+    """Find the best move for a batch of FENs"""
+    try:
+        data = request.get_json() or {}
+        fens = data.get('fens')
+        depth = data.get('depth', 10)
+        
+        if not fens or not isinstance(fens, list) or not all(isinstance(fen, str) for fen in fens):
+            return ojsonify({'success': False, 'error': 'fens list required'}), 400
+        if len(fens) > MAX_ANALYSE_BATCH:
+            return ojsonify({
+                'success': False,
+                'error': f'At most {MAX_ANALYSE_BATCH} positions per request'
+            }), 400
+        if not isinstance(depth, int) or isinstance(depth, bool):
+            return ojsonify({'success': False, 'error': 'depth must be an integer'}), 400
+        depth = max(1, min(20, depth))
+        
+        if not engine_pool.start():
+            return ojsonify({
+                'success': False,
+                'error': 'Could not start chess engine. Please ensure Stockfish is installed.'
+            }), 500
+        
+        # analyse_batch checks every position before any engine sees one
+        try:
+            moves = engine_pool.analyse_batch(fens, depth)
+        except ValueError as e:
+            return ojsonify({'success': False, 'error': f'Invalid FEN: {e}'}), 400
+        
+        return ojsonify({
+            'success': True,
+            'moves': moves
+        })
+    except Exception as e:
+        return ojsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/history', methods=['GET'])
 def get_history():
     """Get game move history"""
     try:
-        return jsonify({
+        game = get_game()
+        if game is None:
+            return no_game()
+        return ojsonify({
             'success': True,
-            'history': game.game_history,
+            'history': game.history(),
             'pgn': game.board.pgn() if hasattr(game.board, 'pgn') else None
         })
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return ojsonify({'success': False, 'error': str(e)}), 500
 
 @app.teardown_appcontext
 def cleanup(error):
@@ -255,7 +907,11 @@ def cleanup(error):
         logger.error(f"Application error: {error}")
 
 if __name__ == '__main__':
+    # Start the engines before the first /api/start, but only in the process
+    # that serves requests: the debug reloader's parent runs this file too
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        engine_pool.start()
     try:
         app.run(debug=True, host='0.0.0.0', port=5000)
     finally:
-        game.stop_engine()
\ No newline at end of file
+        engine_pool.stop()
\ No newline at end of file
@@ -0,0 +1,4 @@
+def post_worker_init(worker):
+    """Start the Stockfish engines in the worker that serves requests"""
+    from app import engine_pool
+    engine_pool.start()